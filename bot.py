@@ -1,106 +1,505 @@
+from __future__ import annotations
+
 import os
+import re
+import sys
+import signal
 import logging
-import sqlite3
 import asyncio
+import warnings
+from collections import OrderedDict, namedtuple
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List, Optional
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, List, Optional, Tuple
+import aiosqlite
+from apscheduler.jobstores.base import JobLookupError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from telegram.helpers import escape_markdown
+from telegram.warnings import PTBUserWarning
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
-    CommandHandler,
     CallbackQueryHandler,
+    ConversationHandler,
     MessageHandler,
     ContextTypes,
+    Defaults,
+    Job,
     filters,
 )
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# Бот обрабатывает только сообщения и нажатия inline-кнопок
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# Long polling: Telegram держит getUpdates до 30 секунд и отдает обновления пачкой
+POLL_TIMEOUT = 30
+# Как часто (в секундах) обновлять сообщение с обратным отсчетом таймера
+TIMER_UPDATE_INTERVAL = 5
+# Задержка правки навигационного сообщения (с): из серии быстрых нажатий уходит только последняя правка
+NAV_EDIT_DELAY = 0.05
+# Состояние диалога ввода веса
+AWAIT_WEIGHT = 1
+
+# ==================== ТЕКСТЫ ====================
+_START_MSG = (
+    "🏋️‍♂️ *Добро пожаловать в Тренировочный Бот!*\n\n"
+    "Я помогу вам пройти 6-недельную программу тренировок:\n"
+    "• Отслеживание прогресса\n"
+    "• Таймер отдыха между подходами\n"
+    "• Подробные описания упражнений\n"
+    "• Статистика и история\n\n"
+    "Используйте /program чтобы начать тренировку!"
+)
+
+_HELP_MSG = (
+    "📚 *Список команд:*\n\n"
+    "*/start* - Начать работу с ботом\n"
+    "*/program* - Открыть программу тренировок\n"
+    "*/progress* - Показать ваш прогресс\n"
+    "*/timer* - Открыть таймер отдыха\n"
+    "*/stats* - Показать статистику\n"
+    "*/reset* - Сбросить прогресс\n\n"
+    "*Как использовать:*\n"
+    "1. Начните с /program\n"
+    "2. Выберите неделю и день\n"
+    "3. Отмечайте выполненные упражнения\n"
+    "4. Используйте таймер для отдыха\n\n"
+    "Удачи в тренировках! 💪"
+)
+
+_PROGRAM_MSG = "📋 *Выберите неделю тренировок:*"
+
+# Готовые аргументы reply_text для статичных ответов: собираются один раз
+_START_REPLY = {
+    "text": _START_MSG,
+    "parse_mode": 'Markdown',
+    "reply_markup": InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 Начать тренировку", callback_data="weeks")],
+        [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")],
+        [InlineKeyboardButton("🆘 Помощь", callback_data="help")]
+    ]),
+    "disable_web_page_preview": True,
+    "disable_notification": True,
+}
+
+_HELP_REPLY = {
+    "text": _HELP_MSG,
+    "parse_mode": 'Markdown',
+    "disable_web_page_preview": True,
+    "disable_notification": True,
+}
+
+_STATIC_REPLIES = {
+    "start": _START_REPLY,
+    "help": _HELP_REPLY,
+}
+
+_TIMER_MSG = "⏱️ *Таймер отдыха между подходами*\n\nВыберите время отдыха:"
+
+# Слова, которые понимаются как команды в обычном тексте
+_PROGRAM_WORDS = frozenset(("программа", "тренировка"))
+_PROGRESS_WORDS = frozenset(("прогресс", "статистика"))
+
+# ==================== КЛАВИАТУРЫ ====================
+# Клавиатуры, не зависящие от пользователя, создаются один раз
+_WEEK_SELECTION_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"📅 Неделя {week}", callback_data=f"w:{week}")] for week in range(1, 7)] # 6 недель
+    + [[
+        InlineKeyboardButton("📊 Текущая тренировка", callback_data="current"),
+        InlineKeyboardButton("🔙 Назад", callback_data="menu")
+    ]]
+)
+
+_TIMER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1:00", callback_data="tm:60"), InlineKeyboardButton("1:30", callback_data="tm:90")],
+    [InlineKeyboardButton("2:00", callback_data="tm:120"), InlineKeyboardButton("2:30", callback_data="tm:150")],
+    [InlineKeyboardButton("3:00", callback_data="tm:180"), InlineKeyboardButton("5:00", callback_data="tm:300")],
+    [InlineKeyboardButton("⏱️ Отдохнуть после упражнения", callback_data="timer")], # Кнопка для вызова из упражнения
+    [InlineKeyboardButton("🔙 Назад", callback_data="menu")]
+])
+
+_MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Программа тренировок", callback_data="weeks")],
+    [InlineKeyboardButton("⏱️ Таймер отдыха", callback_data="timer")],
+    [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")],
+    [InlineKeyboardButton("🆘 Помощь", callback_data="help")]
+])
+
+_PROGRESS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Продолжить тренировку", callback_data="current")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="menu")]
+])
+
+_STATS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Продолжить тренировку", callback_data="current")],
+    [InlineKeyboardButton("📅 История тренировок", callback_data="history")], # Пока без реализации
+    [InlineKeyboardButton("🔙 Назад", callback_data="menu")]
+])
+
+_RESET_CONFIRM_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Да, сбросить всё", callback_data="reset")],
+    [InlineKeyboardButton("❌ Нет, отмена", callback_data="menu")]
+])
+
+_MAIN_MENU_TEXT = "🏋️‍♂️ *Главное меню*\n\nВыберите действие:"
+
 # ==================== БАЗА ДАННЫХ ====================
-class Database:
-    def __init__(self, db_path='training_bot.db'):
+class AioSqlitePool:
+    """Пул заранее открытых соединений aiosqlite"""
+
+    def __init__(self, db_path: str, size: int = 4):
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self.create_tables()
+        self.size = size
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def init(self):
+        """Открытие всех соединений пула"""
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.db_path)
+            conn.row_factory = aiosqlite.Row # Доступ к колонкам по имени
+            # WAL: читатели не ждут писателя; NORMAL: fsync только на контрольных точках WAL
+            await conn.execute('PRAGMA journal_mode=WAL')
+            await conn.execute('PRAGMA synchronous=NORMAL')
+            await conn.execute('PRAGMA temp_store=MEMORY')
+            await conn.execute('PRAGMA mmap_size=268435456') # Чтение страниц через mmap (256 МБ) без копирования
+            await conn.execute('PRAGMA busy_timeout=5000') # Занятая база - ждем до 5 с вместо SQLITE_BUSY
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Взять соединение из пула на время блока async with"""
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            # Незавершенная из-за ошибки транзакция не должна достаться следующему запросу
+            if conn.in_transaction:
+                await conn.rollback()
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        """Закрытие всех соединений пула"""
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        self._idle = None
+
+
+class LRUCache:
+    """Кэш ограниченного размера: при переполнении вытесняются давно не читавшиеся ключи"""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def pop_where(self, predicate):
+        """Удалить все ключи, для которых predicate(key) истинно"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+
+class CacheLoads:
+    """Чтения из базы мимо кэша, идущие прямо сейчас: запись во время чтения не даст закэшировать его результат"""
+
+    def __init__(self):
+        self._loads = {} # {ключ: [версия, число читателей]}; ключ живет, пока идет хоть одно чтение
+
+    @contextmanager
+    def reading(self, key):
+        """Блок чтения; возвращает функцию: True, если за время чтения ключ не меняли"""
+        load = self._loads.setdefault(key, [0, 0])
+        version = load[0]
+        load[1] += 1
+        try:
+            yield lambda: load[0] == version
+        finally:
+            load[1] -= 1
+            if not load[1]:
+                del self._loads[key]
+
+    def bump(self, key):
+        """Отметить запись ключа: идущие чтения могли получить строку до нее"""
+        if load := self._loads.get(key):
+            load[0] += 1
 
-    def create_tables(self):
+    def bump_where(self, predicate):
+        """Отметить запись всех ключей, для которых predicate(key) истинно"""
+        for key, load in self._loads.items():
+            if predicate(key):
+                load[0] += 1
+
+
+_MISSING = object()
+_EMPTY_PROGRESS = MappingProxyType({}) # Неизменяемая заглушка для упражнений без прогресса
+
+
+class Database:
+    def __init__(self, db_path='training_bot.db', pool_size: int = 4):
+        self.db_path = db_path
+        # Соединения живут все время работы бота: кэш страниц SQLite остается теплым
+        self.pool = AioSqlitePool(db_path, pool_size)
+        # Кэши чтения; пользователь сбрасывается при записи, прогресс дня обновляется вслед за ней
+        self._user_cache = LRUCache() # {user_id: строка users}
+        self._progress_cache = LRUCache() # {(user_id, week, day): прогресс дня}
+        # Чтение, начатое до записи и закончившееся после нее, не попадет в кэш
+        self._user_loads = CacheLoads() # По user_id: строка users и позиция
+        self._progress_loads = CacheLoads() # По (user_id, week, day)
+        # Текущие неделя/день отдельно от строки users: их не сбрасывает смена счетчиков
+        self._position_cache = LRUCache() # {user_id: (week, day)}
+        # Накопленные записи истории таймеров; пишутся одним executemany в ближайшей транзакции
+        self._timer_log = []
+        self._timer_log_writing = [] # Записи, взятые сбросом, до COMMIT его транзакции
+        self._timer_flush_queued = False # Сброс уже стоит в очереди писателя
+        # Очередь изменений для группового коммита: (op, future); None - сигнал остановки.
+        # Создается в connect(): очередь привязана к циклу событий, а бот может запускаться повторно
+        self._writes: Optional[asyncio.Queue] = None
+        self._writer_task = None
+
+    async def connect(self):
+        """Открытие соединений с базой данных"""
+        await self.pool.init()
+        await self.create_tables()
+        self._writes = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._group_commit_loop())
+
+    async def close(self):
+        """Закрытие соединений с базой данных"""
+        try:
+            if self._writer_task is not None and not self._writer_task.done():
+                if self._timer_log and not self._timer_flush_queued: # Остались записи после неудачного сброса
+                    self._queue_timer_flush()
+                # Писатель завершит уже поставленные в очередь изменения
+                self._writes.put_nowait(None)
+                await self._writer_task
+            elif self._writer_task is not None and not self._writer_task.cancelled() and self._writer_task.exception():
+                logger.error("Писатель базы данных завершился с ошибкой: %s", self._writer_task.exception())
+            self._writer_task = None
+        finally:
+            await self.pool.close()
+
+    async def create_tables(self):
         """Создание таблиц в базе данных"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT,
-                full_name TEXT,
-                current_week INTEGER DEFAULT 1,
-                current_day INTEGER DEFAULT 1,
-                total_workouts INTEGER DEFAULT 0,
-                total_exercises INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_progress (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                week INTEGER,
-                day INTEGER,
-                exercise_id TEXT,
-                completed BOOLEAN DEFAULT 0,
-                weight REAL DEFAULT NULL,
-                completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(user_id, exercise_id)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS timer_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                exercise_name TEXT,
-                duration_seconds INTEGER,
-                completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        self.conn.commit()
+        # Вся схема - одним скриптом в одной транзакции
+        async with self.pool.acquire() as conn:
+            await conn.executescript('''
+                BEGIN IMMEDIATE;
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    full_name TEXT,
+                    current_week INTEGER DEFAULT 1,
+                    current_day INTEGER DEFAULT 1,
+                    total_workouts INTEGER DEFAULT 0,
+                    total_exercises INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS user_progress (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    week INTEGER,
+                    day INTEGER,
+                    exercise_id TEXT,
+                    completed BOOLEAN DEFAULT 0,
+                    weight REAL DEFAULT NULL,
+                    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    UNIQUE(user_id, exercise_id)
+                );
+                CREATE TABLE IF NOT EXISTS timer_history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    exercise_name TEXT,
+                    duration_seconds INTEGER,
+                    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                );
+                -- Индексы под выборку дня и агрегаты статистики
+                CREATE INDEX IF NOT EXISTS idx_progress_udw ON user_progress(user_id, week, day);
+                CREATE INDEX IF NOT EXISTS idx_progress_completed
+                    ON user_progress(user_id, completed) WHERE completed = 1;
+                -- Обновляем статистику для планировщика запросов
+                ANALYZE;
+                COMMIT;
+            ''')
         logger.info("Таблицы базы данных созданы.")
 
-    def create_user(self, user_id: int, username: str, full_name: str):
-        """Создание нового пользователя"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (id, username, full_name)
-            VALUES (?, ?, ?)
-        ''', (user_id, username, full_name))
-        self.conn.commit()
+    async def _write(self, op):
+        """Выполнить op(conn) в ближайшей групповой транзакции и дождаться ее COMMIT"""
+        self._check_writer()
+        future = asyncio.get_running_loop().create_future()
+        self._writes.put_nowait((op, future))
+        return await future
+
+    def _check_writer(self):
+        """Не ставить изменения в очередь, которую никто не разберет"""
+        if self._writer_task is None or self._writer_task.done():
+            raise RuntimeError("Писатель базы данных не запущен")
+
+    def _write_nowait(self, op, on_done=None):
+        """Поставить op(conn) в очередь писателя, не дожидаясь COMMIT; on_done(future) - после COMMIT или ошибки"""
+        self._check_writer()
+        future = None
+        if on_done is not None:
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(on_done)
+        self._writes.put_nowait((op, future))
+
+    async def _group_commit_loop(self):
+        """Фоновый писатель: все изменения, накопившиеся за время прошлого коммита, - одной транзакцией"""
+        while True:
+            batch = [await self._writes.get()]
+            while not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                await self._commit_batch(batch)
+            if stop:
+                return
+
+    async def _commit_batch(self, batch):
+        """Применить пачку изменений в одной транзакции BEGIN IMMEDIATE ... COMMIT"""
+        results = []
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute('BEGIN IMMEDIATE')
+                for op, future in batch:
+                    # Точка сохранения: ошибка одного изменения не откатывает остальные
+                    await conn.execute('SAVEPOINT write_op')
+                    try:
+                        results.append((future, await op(conn), None))
+                    except Exception as e:
+                        await conn.execute('ROLLBACK TO write_op')
+                        results.append((future, None, e))
+                    await conn.execute('RELEASE write_op')
+                await conn.commit()
+        except Exception as e:
+            logger.exception("Не удалось записать пачку изменений (%d)", len(batch))
+            results = [(future, None, e) for _, future in batch]
+
+        # Вызывающие узнают результат только после COMMIT
+        for future, result, error in results:
+            if future is None:
+                if error is not None: # Ошибку фоновой записи некому передать - пишем в лог
+                    logger.error("Ошибка фоновой записи в базу: %s", error)
+                continue
+            if future.done():
+                continue # Вызывающий обработчик уже отменен
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
-    def get_user(self, user_id: int):
+    async def create_user(self, user_id: int, username: str, full_name: str):
+        """Создание нового пользователя"""
+        async def op(conn):
+            await conn.execute('''
+                INSERT OR IGNORE INTO users (id, username, full_name)
+                VALUES (?, ?, ?)
+            ''', (user_id, username, full_name))
+        await self._write(op)
+        self._invalidate_user(user_id)
+        self._position_cache.pop(user_id) # Новая строка начинается с недели 1, дня 1
+
+    async def get_user(self, user_id: int):
         """Получение информации о пользователе"""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        return cursor.fetchone()
-
-    def update_current_week_day(self, user_id: int, week: int, day: int):
+        user = self._user_cache.get(user_id, _MISSING)
+        if user is not _MISSING:
+            return user
+        with self._user_loads.reading(user_id) as unchanged:
+            async with self.pool.acquire() as conn:
+                async with conn.execute('''
+                    SELECT username, full_name, current_week, current_day,
+                           total_workouts, total_exercises, created_at
+                    FROM users WHERE id = ?
+                ''', (user_id,)) as cursor:
+                    user = await cursor.fetchone()
+        if unchanged():
+            self._user_cache.put(user_id, user)
+            if user is not None:
+                self._position_cache.put(user_id, (user['current_week'], user['current_day']))
+        return user
+
+    def _invalidate_user(self, user_id: int):
+        """Сбросить закэшированную строку users после записи"""
+        self._user_cache.pop(user_id)
+        self._user_loads.bump(user_id)
+
+    async def get_user_stats(self, user_id: int):
+        """Профиль пользователя и агрегаты по выполненным упражнениям одним запросом"""
+        async with self.pool.acquire() as conn:
+            async with conn.execute('''
+                SELECT u.full_name, u.current_week, u.total_workouts, u.total_exercises, u.created_at,
+                       s.workout_days, s.total_sets, s.avg_weight
+                FROM users u,
+                     (SELECT COUNT(DISTINCT date(completed_at)) as workout_days,
+                             COUNT(*) as total_sets,
+                             AVG(weight) as avg_weight
+                      FROM user_progress
+                      WHERE user_id = ? AND completed = 1) s
+                WHERE u.id = ?
+            ''', (user_id, user_id)) as cursor:
+                return await cursor.fetchone()
+
+    async def update_current_week_day(self, user_id: int, week: int, day: int):
         """Обновление текущей недели и дня пользователя"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE users SET current_week = ?, current_day = ? WHERE id = ?
-        ''', (week, day, user_id))
-        self.conn.commit()
+        if self._position_cache.get(user_id) == (week, day):
+            return # Ничего не изменилось - запись не нужна
+        async def op(conn):
+            cursor = await conn.execute('''
+                UPDATE users SET current_week = ?, current_day = ? WHERE id = ?
+            ''', (week, day, user_id))
+            return cursor.rowcount
+        updated = await self._write(op)
+        self._invalidate_user(user_id)
+        if updated: # Строки пользователя еще нет (не нажимал /start) - запоминать нечего
+            self._position_cache.put(user_id, (week, day))
+        else:
+            self._position_cache.pop(user_id)
 
-    def get_user_progress(self, user_id: int, week: int, day: int):
+    async def get_user_progress(self, user_id: int, week: int, day: int):
         """Получение прогресса пользователя для конкретного дня"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT exercise_id, completed, weight FROM user_progress
-            WHERE user_id = ? AND week = ? AND day = ?
-        ''', (user_id, week, day))
-        rows = cursor.fetchall()
+        key = (user_id, week, day)
+        progress = self._progress_cache.get(key)
+        if progress is not None:
+            return progress
+        with self._progress_loads.reading(key) as unchanged:
+            async with self.pool.acquire() as conn:
+                async with conn.execute('''
+                    SELECT exercise_id, completed, weight FROM user_progress
+                    WHERE user_id = ? AND week = ? AND day = ?
+                ''', (user_id, week, day)) as cursor:
+                    rows = await cursor.fetchall()
         progress = {}
         for row in rows:
             exercise_id, completed, weight = row
@@ -108,519 +507,731 @@ class Database:
                 'completed': bool(completed),
                 'weight': weight
             }
+        if unchanged(): # Пока шел запрос, день не менялся - результат можно кэшировать
+            self._progress_cache.put(key, progress)
         return progress
 
-    def update_exercise_status(self, user_id: int, week: int, day: int, exercise_id: str, completed: bool):
+    async def update_exercise_status(self, user_id: int, week: int, day: int, exercise_id: str, completed: bool):
         """Обновление статуса выполнения упражнения"""
-        cursor = self.conn.cursor()
-        # Проверяем, существует ли запись
-        cursor.execute('''
-            SELECT completed FROM user_progress WHERE user_id = ? AND exercise_id = ?
-        ''', (user_id, exercise_id))
-        existing = cursor.fetchone()
-
-        if existing is not None:
-            # Обновляем существующую запись
-            cursor.execute('''
-                UPDATE user_progress SET completed = ?, week = ?, day = ?, completed_at = CURRENT_TIMESTAMP
-                WHERE user_id = ? AND exercise_id = ?
-            ''', (int(completed), week, day, user_id, exercise_id))
-        else:
-            # Вставляем новую запись
-            cursor.execute('''
+        # Писатель держит блокировку записи всю транзакцию: чтение старого статуса и запись не разъедутся
+        async def op(conn):
+            async with conn.execute('''
+                SELECT completed FROM user_progress WHERE user_id = ? AND exercise_id = ?
+            ''', (user_id, exercise_id)) as cursor:
+                existing = await cursor.fetchone()
+
+            await conn.execute('''
                 INSERT INTO user_progress (user_id, week, day, exercise_id, completed)
                 VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, exercise_id) DO UPDATE SET
+                    completed = excluded.completed,
+                    week = excluded.week,
+                    day = excluded.day,
+                    completed_at = CURRENT_TIMESTAMP
             ''', (user_id, week, day, exercise_id, int(completed)))
 
-        # Обновляем статистику пользователя
-        if completed and not existing: # Только если стало выполненным и ранее не было
-            cursor.execute('''
-                UPDATE users SET total_exercises = total_exercises + 1 WHERE id = ?
-            ''', (user_id,))
-        elif not completed and existing and existing[0] == 1: # Только если стало невыполненным и ранее было выполнено
-             cursor.execute('''
-                UPDATE users SET total_exercises = total_exercises - 1 WHERE id = ?
-            ''', (user_id,))
-
-        self.conn.commit()
-
-    def save_exercise_weight(self, user_id: int, week: int, day: int, exercise_id: str, weight: float):
+            # Счетчик выполненных упражнений меняется только при смене статуса
+            delta = int(completed) - int(bool(existing and existing['completed']))
+            if delta:
+                await conn.execute('''
+                    UPDATE users SET total_exercises = total_exercises + ? WHERE id = ?
+                ''', (delta, user_id))
+        await self._write(op)
+        self._invalidate_user(user_id)
+        self._patch_progress(user_id, week, day, exercise_id, completed=bool(completed))
+
+    async def save_exercise_weight(self, user_id: int, week: int, day: int, exercise_id: str, weight: float):
         """Сохранение веса для упражнения"""
-        cursor = self.conn.cursor()
-        # Обновляем или вставляем вес
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_progress (user_id, week, day, exercise_id, weight, completed_at)
-            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, week, day, exercise_id, weight))
-        self.conn.commit()
-
-    def log_timer_usage(self, user_id: int, exercise_name: str, duration_seconds: int):
-        """Логирование использования таймера"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        async def op(conn):
+            # Обновляем или вставляем вес; статус выполнения при этом сохраняется
+            await conn.execute('''
+                INSERT INTO user_progress (user_id, week, day, exercise_id, weight)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, exercise_id) DO UPDATE SET
+                    weight = excluded.weight,
+                    completed_at = CURRENT_TIMESTAMP
+            ''', (user_id, week, day, exercise_id, weight))
+        await self._write(op)
+        self._patch_progress(user_id, week, day, exercise_id, weight=weight)
+
+    def _patch_progress(self, user_id: int, week: int, day: int, exercise_id: str, **fields):
+        """Обновить закэшированный прогресс дня после записи, чтобы следующая перерисовка не шла в базу"""
+        key = (user_id, week, day)
+        self._progress_loads.bump(key)
+        progress = self._progress_cache.get(key)
+        if progress is None:
+            return
+        # Новый словарь, а не правка на месте: вызывающие могут держать ссылку на старый
+        entry = progress.get(exercise_id) or {'completed': False, 'weight': None}
+        self._progress_cache.put(key, {**progress, exercise_id: {**entry, **fields}})
+
+    async def reset_user(self, user_id: int):
+        """Сброс всего прогресса пользователя"""
+        async def op(conn):
+            await conn.execute('DELETE FROM user_progress WHERE user_id = ?', (user_id,))
+            await conn.execute('UPDATE users SET total_exercises = 0, total_workouts = 0 WHERE id = ?', (user_id,))
+        await self._write(op)
+        self._invalidate_user(user_id)
+        self._progress_cache.pop_where(lambda key: key[0] == user_id)
+        self._progress_loads.bump_where(lambda key: key[0] == user_id)
+
+    async def log_timer_usage(self, user_id: int, exercise_name: str, duration_seconds: int):
+        """Логирование использования таймера (запись уходит в базу с ближайшей транзакцией писателя)"""
+        self._timer_log.append((user_id, exercise_name, duration_seconds))
+        if not self._timer_flush_queued: # Первая запись пачки - ставим ее сброс в очередь
+            self._queue_timer_flush()
+
+    def _queue_timer_flush(self):
+        """Поставить сброс истории таймеров в очередь писателя"""
+        self._write_nowait(self._flush_timer_log, on_done=self._timer_flush_done)
+        self._timer_flush_queued = True
+
+    async def _flush_timer_log(self, conn):
+        """Записать накопленную историю таймеров одним executemany"""
+        self._timer_log_writing, self._timer_log = self._timer_log, []
+        await conn.executemany('''
             INSERT INTO timer_history (user_id, exercise_name, duration_seconds)
             VALUES (?, ?, ?)
-        ''', (user_id, exercise_name, duration_seconds))
-        self.conn.commit()
+        ''', self._timer_log_writing)
+
+    def _timer_flush_done(self, future: asyncio.Future):
+        """Итог сброса истории таймеров: при ошибке записи возвращаются в буфер"""
+        self._timer_flush_queued = False
+        if future.cancelled() or future.exception() is not None:
+            if not future.cancelled():
+                logger.error("Ошибка записи истории таймеров: %s", future.exception())
+            # Следующий сброс поставит новая запись или close(); сразу не повторяем, чтобы не зациклиться на ошибке
+            self._timer_log = self._timer_log_writing + self._timer_log
+        elif self._timer_log: # Записи, пришедшие пока шла транзакция
+            self._queue_timer_flush()
+        self._timer_log_writing = []
 
 
 # ==================== ПРОГРАММА ТРЕНИРОВОК ====================
+# Элементы программы - неизменяемые кортежи, создаются один раз при импорте
+SetSpec = namedtuple('SetSpec', 'reps rir_text')
+ExerciseSpec = namedtuple('ExerciseSpec', 'id name group type sets_details rir muscles description sets')
+DaySpec = namedtuple('DaySpec', 'name intensity reps sets rir_scheme warmup exercises')
+
+# --- Полная программа: {неделя: {день: DaySpec}} ---
+FULL_PROGRAM = MappingProxyType({
+    1: { # Неделя 1
+        1: DaySpec( # День 1
+            name="Высокоинтенсивный день",
+            intensity="Высокоинтенсивный",
+            reps="6-8 повторений",
+            sets="2 рабочих подхода",
+            rir_scheme="1 подход RIR2, 2 подход RIR1",
+            warmup="5-7 минут кардио + суставная разминка",
+            exercises=(
+                ExerciseSpec(
+                    id="1-1-1",
+                    name="СКРУЧИВАНИЕ ТАЗА В ВИСЕ НА ПРЕСС",
+                    group="Пресс",
+                    type="Односуставное",
+                    sets_details="2 подхода, около 15 повторений",
+                    rir="RIR0",
+                    muscles=("Пресс",),
+                    description="Упражнение для нижней части пресса.",
+                    sets=(
+                        SetSpec("15", "RIR2"),
+                        SetSpec("15", "RIR1"),
+                    ),
+                ),
+                ExerciseSpec(
+                    id="1-1-2",
+                    name="ЖИМ ШТАНГИ ЛЕЖА",
+                    group="Грудные",
+                    type="Многосуставное",
+                    sets_details="2 подхода",
+                    rir="RIR1",
+                    muscles=("Грудные", "Передние дельты", "Трицепсы"),
+                    description="Классическое упражнение для развития грудных мышц.",
+                    sets=(
+                        SetSpec("6-8", "RIR2"),
+                        SetSpec("6-8", "RIR1"),
+                    ),
+                ),
+                # ... добавьте остальные упражнения для дня 1 ...
+            ),
+        ),
+        2: DaySpec( # День 2
+            name="Среднеинтенсивный день",
+            intensity="Среднеинтенсивный",
+            reps="10-12 повторений",
+            sets="3 рабочих подхода",
+            rir_scheme="1 и 2 подход RIR1, 3 подход RIR0",
+            warmup="5-7 минут кардио + суставная разминка",
+            exercises=(
+                ExerciseSpec(
+                    id="1-2-1",
+                    name="МОЛИТВА",
+                    group="Пресс",
+                    type="Односуставное",
+                    sets_details="2 подхода, около 15 повторений",
+                    rir="RIR0",
+                    muscles=("Пресс", "Нижняя часть спины"),
+                    description="Упражнение на стабилизацию корпуса.",
+                    sets=(
+                        SetSpec("10-12", "RIR1"),
+                        SetSpec("10-12", "RIR0"),
+                    ),
+                ),
+                # ... добавьте остальные упражнения для дня 2 ...
+            ),
+        ),
+        3: DaySpec( # День 3
+            name="Низкоинтенсивный день",
+            intensity="Низкоинтенсивный",
+            reps="15-20 повторений",
+            sets="1-2 рабочих подхода",
+            rir_scheme="RIR2-RIR3",
+            warmup="5-7 минут кардио + суставная разминка",
+            exercises=(
+                # ... упражнения для дня 3 ...
+            ),
+        ),
+    },
+    # ... Добавьте недели 2-6 по аналогии ...
+    2: { # Неделя 2
+        1: DaySpec( # День 1
+            name="Высокоинтенсивный день 2",
+            intensity="Высокоинтенсивный",
+            reps="5-7 повторений",
+            sets="3 рабочих подхода",
+            rir_scheme="1 подход RIR3, 2 подход RIR2, 3 подход RIR1",
+            warmup="10 минут кардио + динамическая разминка",
+            exercises=(
+                ExerciseSpec(
+                    id="2-1-1",
+                    name="ПРИСЕДАНИЯ СО ШТАНГОЙ",
+                    group="Ноги",
+                    type="Многосуставное",
+                    sets_details="3 подхода",
+                    rir="RIR1",
+                    muscles=("Квадрицепсы", "Ягодицы", "Подколенные сухожилия"),
+                    description="Базовое упражнение для ног.",
+                    sets=(
+                        SetSpec("5-7", "RIR3"),
+                        SetSpec("5-7", "RIR2"),
+                        SetSpec("5-7", "RIR1"),
+                    ),
+                ),
+                # ... остальные упражнения ...
+            ),
+        ),
+        # ... Дни 2 и 3 недели 2 ...
+    },
+    # ... Остальные недели 3-6 ...
+})
+
+# Плоский индекс дней: один поиск по (неделя, день) вместо обхода вложенных словарей
+_DAYS = {
+    (week_num, day_num): day_data
+    for week_num, week_data in FULL_PROGRAM.items()
+    for day_num, day_data in week_data.items()
+}
+# Плоский индекс упражнений по (неделя, день, номер в дне)
+_EXERCISES = {
+    (week_num, day_num, index): exercise
+    for (week_num, day_num), day_data in _DAYS.items()
+    for index, exercise in enumerate(day_data.exercises)
+}
+# Шапка дня одинакова для всех пользователей - форматируем ее один раз
+_DAY_HEADERS = {
+    (week_num, day_num): (
+        f"*Неделя {week_num}, {day_data.name}*\n\n"
+        f"💪 *Интенсивность:* {day_data.intensity}\n"
+        f"🔢 *Повторения:* {day_data.reps}\n"
+        f"📊 *Подходы:* {day_data.sets}\n"
+        f"🎯 *Схема RIR:* {day_data.rir_scheme}\n"
+        f"🔥 *Разминка:* {day_data.warmup}\n\n"
+        f"*Упражнения:*"
+    )
+    for (week_num, day_num), day_data in _DAYS.items()
+}
+
+
+@lru_cache(maxsize=None)
+def _day_selection_markup(week_num: int) -> InlineKeyboardMarkup:
+    """Клавиатура выбора дня недели; программа неизменна, поэтому строится один раз на неделю"""
+    week_data = FULL_PROGRAM.get(week_num, {})
+    keyboard = [
+        (InlineKeyboardButton(
+            f"🏋️‍♂️ {week_data[day].name if day in week_data else f'День {day}'}",
+            callback_data=f"d:{week_num}:{day}"
+        ),)
+        for day in range(1, 4) # 3 дня в неделе
+    ]
+    keyboard.append((InlineKeyboardButton("🔙 Назад", callback_data="weeks"),))
+    return InlineKeyboardMarkup(keyboard)
+
+
 class TrainingProgram:
-    def __init__(self):
-        # --- Полная программа ---
-        self.full_program = {
-            1: { # Неделя 1
-                1: { # День 1
-                    "name": "Высокоинтенсивный день",
-                    "intensity": "Высокоинтенсивный",
-                    "reps": "6-8 повторений",
-                    "sets": "2 рабочих подхода",
-                    "rir_scheme": "1 подход RIR2, 2 подход RIR1",
-                    "warmup": "5-7 минут кардио + суставная разминка",
-                    "exercises": [
-                        {
-                            "id": "1-1-1",
-                            "name": "СКРУЧИВАНИЕ ТАЗА В ВИСЕ НА ПРЕСС",
-                            "group": "Пресс",
-                            "type": "Односуставное",
-                            "sets_details": "2 подхода, около 15 повторений",
-                            "rir": "RIR0",
-                            "muscles": ["Пресс"],
-                            "description": "Упражнение для нижней части пресса.",
-                            "sets": [
-                                {"reps": "15", "rir_text": "RIR2"},
-                                {"reps": "15", "rir_text": "RIR1"}
-                            ]
-                        },
-                        {
-                            "id": "1-1-2",
-                            "name": "ЖИМ ШТАНГИ ЛЕЖА",
-                            "group": "Грудные",
-                            "type": "Многосуставное",
-                            "sets_details": "2 подхода",
-                            "rir": "RIR1",
-                            "muscles": ["Грудные", "Передние дельты", "Трицепсы"],
-                            "description": "Классическое упражнение для развития грудных мышц.",
-                            "sets": [
-                                {"reps": "6-8", "rir_text": "RIR2"},
-                                {"reps": "6-8", "rir_text": "RIR1"}
-                            ]
-                        },
-                        # ... добавьте остальные упражнения для дня 1 ...
-                    ]
-                },
-                2: { # День 2
-                    "name": "Среднеинтенсивный день",
-                    "intensity": "Среднеинтенсивный",
-                    "reps": "10-12 повторений",
-                    "sets": "3 рабочих подхода",
-                    "rir_scheme": "1 и 2 подход RIR1, 3 подход RIR0",
-                    "warmup": "5-7 минут кардио + суставная разминка",
-                    "exercises": [
-                        {
-                            "id": "1-2-1",
-                            "name": "МОЛИТВА",
-                            "group": "Пресс",
-                            "type": "Односуставное",
-                            "sets_details": "2 подхода, около 15 повторений",
-                            "rir": "RIR0",
-                            "muscles": ["Пресс", "Нижняя часть спины"],
-                            "description": "Упражнение на стабилизацию корпуса.",
-                            "sets": [
-                                {"reps": "10-12", "rir_text": "RIR1"},
-                                {"reps": "10-12", "rir_text": "RIR0"}
-                            ]
-                        },
-                        # ... добавьте остальные упражнения для дня 2 ...
-                    ]
-                },
-                3: { # День 3
-                    "name": "Низкоинтенсивный день",
-                    "intensity": "Низкоинтенсивный",
-                    "reps": "15-20 повторений",
-                    "sets": "1-2 рабочих подхода",
-                    "rir_scheme": "RIR2-RIR3",
-                    "warmup": "5-7 минут кардио + суставная разминка",
-                    "exercises": [
-                         # ... упражнения для дня 3 ...
-                    ]
-                }
-            },
-            # ... Добавьте недели 2-6 по аналогии ...
-             2: { # Неделя 2
-                1: { # День 1
-                    "name": "Высокоинтенсивный день 2",
-                    "intensity": "Высокоинтенсивный",
-                    "reps": "5-7 повторений",
-                    "sets": "3 рабочих подхода",
-                    "rir_scheme": "1 подход RIR3, 2 подход RIR2, 3 подход RIR1",
-                    "warmup": "10 минут кардио + динамическая разминка",
-                    "exercises": [
-                        {
-                            "id": "2-1-1",
-                            "name": "ПРИСЕДАНИЯ СО ШТАНГОЙ",
-                            "group": "Ноги",
-                            "type": "Многосуставное",
-                            "sets_details": "3 подхода",
-                            "rir": "RIR1",
-                            "muscles": ["Квадрицепсы", "Ягодицы", "Подколенные сухожилия"],
-                            "description": "Базовое упражнение для ног.",
-                            "sets": [
-                                {"reps": "5-7", "rir_text": "RIR3"},
-                                {"reps": "5-7", "rir_text": "RIR2"},
-                                {"reps": "5-7", "rir_text": "RIR1"}
-                            ]
-                        },
-                        # ... остальные упражнения ...
-                    ]
-                },
-                # ... Дни 2 и 3 недели 2 ...
-            },
-            # ... Остальные недели 3-6 ...
-        }
+    """Доступ к общей для всех программе тренировок"""
 
-    def get_week(self, week_num: int) -> Optional[Dict]:
+    def get_week(self, week_num: int) -> Optional[Dict[int, DaySpec]]:
         """Получить данные недели"""
-        return self.full_program.get(week_num)
+        return FULL_PROGRAM.get(week_num)
 
-    def get_day(self, week_num: int, day_num: int) -> Optional[Dict]:
+    def get_day_selection_markup(self, week_num: int) -> InlineKeyboardMarkup:
+        """Получить клавиатуру выбора дня недели"""
+        return _day_selection_markup(week_num)
+
+    def get_day(self, week_num: int, day_num: int) -> Optional[DaySpec]:
         """Получить данные дня"""
-        week_data = self.get_week(week_num)
-        if week_data:
-            return week_data.get(day_num)
-        return None
+        return _DAYS.get((week_num, day_num))
+
+    def get_day_header(self, week_num: int, day_num: int) -> Optional[str]:
+        """Получить готовую шапку дня в Markdown"""
+        return _DAY_HEADERS.get((week_num, day_num))
 
-    def get_exercise(self, week_num: int, day_num: int, exercise_index: int) -> Optional[Dict]:
+    def get_exercise(self, week_num: int, day_num: int, exercise_index: int) -> Optional[ExerciseSpec]:
         """Получить данные упражнения по индексу в дне"""
-        day_data = self.get_day(week_num, day_num)
-        if day_data and "exercises" in day_data:
-            exercises = day_data["exercises"]
-            if 0 <= exercise_index < len(exercises):
-                return exercises[exercise_index]
-        return None
+        return _EXERCISES.get((week_num, day_num, exercise_index))
+
+
+# ==================== HTTP ====================
+class BotAPIRequest(HTTPXRequest):
+    """HTTPXRequest, разбирающий ответы Bot API через orjson, если он установлен"""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict:
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass # Стандартный разбор заменит битые байты или выдаст TelegramError
+        return HTTPXRequest.parse_json_payload(payload)
 
 
 # ==================== ТЕЛЕГРАМ БОТ ====================
+@dataclass(slots=True)
+class TimerState:
+    """Активный таймер отдыха одного чата"""
+    seconds: int # Сколько осталось
+    initial_seconds: int
+    message_id: int # Сообщение с обратным отсчетом
+    name: str
+    job: Optional[Job] = None # Следующий тик в JobQueue
+
+
 class TrainingBot:
     def __init__(self, token: str):
         self.token = token
         self.db = Database()
         self.program = TrainingProgram()
-        self.user_timers = {} # {user_id: {"seconds": int, "message_id": int, "exercise_name": str}}
-        self.active_timers = {} # {user_id: timer_task}
-
-        # Создаем приложение
-        self.application = Application.builder().token(token).build()
+        self.timers: Dict[int, TimerState] = {} # {chat_id: активный таймер}
+        # Правки навигационных сообщений: {(chat_id, message_id): задача, отправляющая правки по очереди}
+        self._pending_edits: Dict[Tuple[int, int], asyncio.Task] = {}
+        # {(chat_id, message_id): (текст, клавиатура, parse_mode) последней правки}; текст None - правка только клавиатуры
+        self._next_edits: Dict[Tuple[int, int], tuple] = {}
+        # Статичные ответы, заранее отправленные в служебный чат: {ключ: message_id}
+        self.static_chat_id = os.getenv('STATIC_CACHE_CHAT_ID')
+        self.static_message_ids = {}
+
+        # Создаем приложение; обновления от разных чатов обрабатываются параллельно,
+        # запросы к Bot API идут по HTTP/2 через общее TLS-соединение
+        self.application = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(True)
+            # Обработчики не блокируют диспетчер: каждый колбэк выполняется отдельной задачей
+            .defaults(Defaults(block=False))
+            # Большой пул - правки таймеров не занимают все соединения; свободное ждем не дольше 10 с.
+            # Зависшее соединение или ответ не держат обработчик дольше 5 с / 20 с
+            .request(BotAPIRequest(
+                connection_pool_size=256, pool_timeout=10, connect_timeout=5, read_timeout=20, http_version="2"
+            ))
+            # getUpdates всегда один: ему хватает одного соединения.
+            # Таймаут чтения для него PTB сам увеличивает на время long polling
+            .get_updates_request(BotAPIRequest(
+                connection_pool_size=1, pool_timeout=10, connect_timeout=5, http_version="2"
+            ))
+            .build()
+        )
 
         # Регистрируем обработчики
         self.setup_handlers()
 
     def setup_handlers(self):
         """Настройка всех обработчиков команд"""
-        # Команды
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("program", self.program_command))
-        self.application.add_handler(CommandHandler("progress", self.progress_command))
-        self.application.add_handler(CommandHandler("timer", self.timer_command))
-        self.application.add_handler(CommandHandler("stats", self.stats_command))
-        self.application.add_handler(CommandHandler("reset", self.reset_command))
-
-        # Обработчики callback-запросов (кнопки)
+        # Команды: один обработчик, который ищет команду в таблице
+        self.commands = {
+            "start": self.start_command,
+            "help": self.help_command,
+            "program": self.program_command,
+            "progress": self.progress_command,
+            "timer": self.timer_command,
+            "stats": self.stats_command,
+            "reset": self.reset_command,
+        }
+        # Одно регулярное выражение на все команды вместо отдельного фильтра на каждую
+        # Суффикс @имя_бота выделяется группой bot: команды другим ботам в группе не обрабатываем
+        command_pattern = re.compile(r'^/(' + '|'.join(self.commands) + r')(?:@(?P<bot>\w+))?(?:\s|$)', re.IGNORECASE)
+        self.application.add_handler(MessageHandler(filters.Regex(command_pattern), self.command_dispatcher))
+
+        # Ввод веса: диалог начинается кнопкой подхода, ждет число и завершается сам
+        with warnings.catch_warnings():
+            # Диалог намеренно ведется на чат, а не на сообщение: вес приходит текстом, а не кнопкой.
+            # PTB предупреждает об этом для CallbackQueryHandler даже при явном per_message=False
+            warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
+            weight_conversation = ConversationHandler(
+                entry_points=[CallbackQueryHandler(self.prompt_weight, pattern=r'^wt:')],
+                states={
+                    AWAIT_WEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, self.receive_weight)],
+                    # Обновления, пришедшие пока шаг диалога еще выполняется
+                    ConversationHandler.WAITING: [
+                        CallbackQueryHandler(self.weight_busy, pattern=r'^wt:'),
+                        MessageHandler(filters.TEXT & ~filters.COMMAND, self.weight_busy),
+                    ],
+                },
+                fallbacks=[MessageHandler(filters.Regex(r'^/cancel(?:@(?P<bot>\w+))?(?:\s|$)'), self.cancel_weight)],
+                allow_reentry=True, # Можно сразу выбрать другой подход
+                per_message=False,
+                # Шаги диалога выполняются в обработке своего обновления, а не отдельной задачей
+                # (Defaults(block=False)): иначе при concurrent_updates следующее обновление
+                # не видит состояния и уходит общим обработчикам кнопок и текста
+                block=True,
+            )
+        self.application.add_handler(weight_conversation)
+
+        # Кнопки: callback_data вида "вид:число:число", вид ищется в таблице
+        self.callbacks = {
+            "w": self._on_week, # w:неделя - выбор дня
+            "d": self._on_day, # d:неделя:день - список упражнений
+            "ex": self._on_exercise, # ex:неделя:день:номер - карточка упражнения
+            "done": self._on_toggle_complete, # done:неделя:день:номер
+            "tm": self._on_timer, # tm:секунды
+            "tmex": self._on_timer_exercise, # tmex:неделя:день:номер
+            "timer": self.timer_command,
+            "weeks": self._on_week_selection,
+            "menu": self._on_main_menu,
+            "current": self._on_current_training,
+            "help": self.help_command,
+            "stats": self.stats_command,
+            "reset": self._on_reset_confirm,
+        }
+        # Эти кнопки сами отвечают на callback всплывающим уведомлением
+        self.toast_callbacks = frozenset((self._on_timer, self._on_timer_exercise))
         self.application.add_handler(CallbackQueryHandler(self.button_handler))
 
         # Обработчики текстовых сообщений (для ввода веса)
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.message_handler))
 
 
+    async def command_dispatcher(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Вызов обработчика команды по таблице self.commands"""
+        # Имя команды уже выделено фильтром: "/start@BotName args" -> "start"
+        match = context.matches[0]
+        if not self._addressed_to_me(match, context):
+            return
+        await self.commands[match.group(1).lower()](update, context)
+
+    @staticmethod
+    def _addressed_to_me(match: re.Match, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Команда без суффикса или с @именем этого бота"""
+        mention = match.group('bot')
+        return mention is None or mention.lower() == context.bot.username.lower()
+
+
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         user = update.effective_user
-        self.db.create_user(user.id, user.username, user.full_name)
-        welcome_text = (
-            "🏋️‍♂️ *Добро пожаловать в Тренировочный Бот!*\n\n"
-            "Я помогу вам пройти 6-недельную программу тренировок:\n"
-            "• Отслеживание прогресса\n"
-            "• Таймер отдыха между подходами\n"
-            "• Подробные описания упражнений\n"
-            "• Статистика и история\n\n"
-            "Используйте /program чтобы начать тренировку!"
-        )
-        keyboard = [
-            [InlineKeyboardButton("📋 Начать тренировку", callback_data="program_main")],
-            [InlineKeyboardButton("📊 Моя статистика", callback_data="stats_main")],
-            [InlineKeyboardButton("🆘 Помощь", callback_data="help_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(welcome_text, parse_mode='Markdown', reply_markup=reply_markup)
+        await self.db.create_user(user.id, user.username, user.full_name)
+        await self.send_static_reply(update.effective_message, "start")
 
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
-        help_text = (
-            "📚 *Список команд:*\n\n"
-            "*/start* - Начать работу с ботом\n"
-            "*/program* - Открыть программу тренировок\n"
-            "*/progress* - Показать ваш прогресс\n"
-            "*/timer* - Открыть таймер отдыха\n"
-            "*/stats* - Показать статистику\n"
-            "*/reset* - Сбросить прогресс\n\n"
-            "*Как использовать:*\n"
-            "1. Начните с /program\n"
-            "2. Выберите неделю и день\n"
-            "3. Отмечайте выполненные упражнения\n"
-            "4. Используйте таймер для отдыха\n\n"
-            "Удачи в тренировках! 💪"
+        await self.send_static_reply(update.effective_message, "help")
+
+
+    async def cache_static_replies(self):
+        """Отправить статичные ответы в служебный чат, чтобы дальше копировать их по message_id"""
+        if not self.static_chat_id:
+            return
+        for key, reply in _STATIC_REPLIES.items():
+            try:
+                message = await self.application.bot.send_message(chat_id=self.static_chat_id, **reply)
+            except TelegramError as e:
+                logger.warning("Не удалось закэшировать ответ %s: %s", key, e)
+                return
+            self.static_message_ids[key] = message.message_id
+
+    async def send_static_reply(self, message, key: str):
+        """Ответить статичным текстом: копией из служебного чата, если она есть"""
+        reply = _STATIC_REPLIES[key]
+        message_id = self.static_message_ids.get(key)
+        if message_id is None:
+            await message.reply_text(**reply)
+            return
+        # copyMessage передает только ссылку на сообщение вместо всего текста
+        await self.application.bot.copy_message(
+            chat_id=message.chat_id,
+            from_chat_id=self.static_chat_id,
+            message_id=message_id,
+            reply_markup=reply.get("reply_markup"),
+            disable_notification=True
         )
-        await update.message.reply_text(help_text, parse_mode='Markdown')
 
 
     async def program_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать меню программы"""
-        await self.show_week_selection(update.effective_chat.id, update.message.message_id if update.message else None)
+        # Сообщение пользователя отредактировать нельзя - отправляем новое
+        await self.show_week_selection(update.effective_chat.id)
 
     async def show_week_selection(self, chat_id: int, message_id: int = None):
         """Показать выбор недели"""
-        keyboard = []
-        for week in range(1, 7): # 6 недель
-            keyboard.append([InlineKeyboardButton(f"📅 Неделя {week}", callback_data=f"week_{week}")])
-        keyboard.append([
-            InlineKeyboardButton("📊 Текущая тренировка", callback_data="current_training"),
-            InlineKeyboardButton("🔙 Назад", callback_data="main_menu")
-        ])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        text = "📋 *Выберите неделю тренировок:*"
         if message_id:
-            await self.application.bot.edit_message_text(
-                chat_id=chat_id, message_id=message_id, text=text, parse_mode='Markdown', reply_markup=reply_markup
-            )
+            self._edit_nav_message(chat_id, message_id, _PROGRAM_MSG, _WEEK_SELECTION_MARKUP)
         else:
-            await self.application.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
+            await self.application.bot.send_message(
+                chat_id=chat_id, text=_PROGRAM_MSG, parse_mode='Markdown', reply_markup=_WEEK_SELECTION_MARKUP,
+                disable_web_page_preview=True, disable_notification=True
+            )
 
     async def show_day_selection(self, chat_id: int, week: int, message_id: int):
         """Показать выбор дня для недели"""
-        week_data = self.program.get_week(week)
-        if not week_data:
-            await self.application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="Ошибка: неделя не найдена.")
+        if not self.program.get_week(week):
+            self._edit_nav_message(chat_id, message_id, "Ошибка: неделя не найдена.")
             return
 
-        keyboard = []
-        for day in range(1, 4): # 3 дня в неделе
-            day_name = week_data[day]["name"] if day in week_data else f"День {day}"
-            keyboard.append([InlineKeyboardButton(f"🏋️‍♂️ {day_name}", callback_data=f"day_{week}_{day}")])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"back_to_weeks")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        text = f"📅 *Выберите день для Недели {week}:*"
-        await self.application.bot.edit_message_text(
-            chat_id=chat_id, message_id=message_id, text=text, parse_mode='Markdown', reply_markup=reply_markup
-        )
+        reply_markup = self.program.get_day_selection_markup(week)
+        self._edit_nav_message(chat_id, message_id, f"📅 *Выберите день для Недели {week}:*", reply_markup)
+
+    def _edit_nav_message(self, chat_id: int, message_id: int, text: Optional[str],
+                          reply_markup: InlineKeyboardMarkup = None, parse_mode: Optional[str] = 'Markdown'):
+        """Отложенная правка сообщения с навигацией: из серии правок одного сообщения уходит последняя"""
+        key = (chat_id, message_id)
+        self._next_edits[key] = (text, reply_markup, parse_mode)
+        if key not in self._pending_edits:
+            self._pending_edits[key] = asyncio.create_task(self._send_edits(key))
+
+    def _edit_nav_markup(self, chat_id: int, message_id: int, reply_markup: InlineKeyboardMarkup, text: str):
+        """Отложенная правка только клавиатуры; text - текст сообщения, к которому она относится"""
+        # Пока ждет или уходит другая правка, на экране может оказаться уже не этот текст -
+        # тогда отправляем сообщение целиком, чтобы клавиатура не попала под чужой текст
+        if (chat_id, message_id) in self._pending_edits:
+            self._edit_nav_message(chat_id, message_id, text, reply_markup)
+        else:
+            self._edit_nav_message(chat_id, message_id, None, reply_markup, parse_mode=None)
+
+    async def _send_edits(self, key: Tuple[int, int]):
+        """Отправлять правки сообщения по одной, пока появляются новые"""
+        chat_id, message_id = key
+        try:
+            while key in self._next_edits:
+                # За время ожидания новые нажатия только заменяют текст следующей правки
+                await asyncio.sleep(NAV_EDIT_DELAY)
+                text, reply_markup, parse_mode = self._next_edits.pop(key)
+                try:
+                    # Следующая правка уйдет только после ответа на эту: порядок на экране сохраняется
+                    if text is None:
+                        await self.application.bot.edit_message_reply_markup(
+                            chat_id=chat_id, message_id=message_id, reply_markup=reply_markup
+                        )
+                    else:
+                        await self.application.bot.edit_message_text(
+                            chat_id=chat_id, message_id=message_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup
+                        )
+                except Exception as e:
+                    logger.warning("Ошибка правки сообщения: %s", e)
+        finally:
+            # Задача убирает себя сама, без await: новая правка после этого запустит новую задачу
+            del self._pending_edits[key]
+            self._next_edits.pop(key, None)
 
     async def show_exercise_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int):
         """Показать список упражнений для дня"""
         query = update.callback_query
         user_id = query.from_user.id
-        chat_id = query.message.chat_id
-        message_id = query.message.message_id
 
         day_data = self.program.get_day(week, day)
         if not day_data:
-            await query.edit_message_text(text="Ошибка: день не найден.")
+            self._edit_nav_message(query.message.chat_id, query.message.message_id, "Ошибка: день не найден.")
             return
 
         # Обновляем текущую неделю/день пользователя
-        self.db.update_current_week_day(user_id, week, day)
+        await self.db.update_current_week_day(user_id, week, day)
 
         # Получаем прогресс пользователя
-        progress = self.db.get_user_progress(user_id, week, day)
-
-        # Формируем текст дня
-        day_text = (
-            f"*Неделя {week}, {day_data['name']}*\n\n"
-            f"💪 *Интенсивность:* {day_data['intensity']}\n"
-            f"🔢 *Повторения:* {day_data['reps']}\n"
-            f"📊 *Подходы:* {day_data['sets']}\n"
-            f"🎯 *Схема RIR:* {day_data['rir_scheme']}\n"
-            f"🔥 *Разминка:* {day_data['warmup']}\n\n"
-            f"*Упражнения:*"
-        )
+        progress = await self.db.get_user_progress(user_id, week, day)
 
-        keyboard = []
-        for i, exercise in enumerate(day_data["exercises"]):
-            exercise_id = exercise["id"]
-            status = "✅" if progress.get(exercise_id, {}).get('completed', False) else "⭕"
-            weight_info = f" ⚖️ {progress.get(exercise_id, {}).get('weight', '?')} кг" if progress.get(exercise_id, {}).get('weight') else ""
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{status} {exercise['name']}{weight_info}",
-                    callback_data=f"exercise_{week}_{day}_{i}"
-                )
-            ])
+        day_text = self.program.get_day_header(week, day)
+
+        # Строки клавиатуры - кортежи, список собирается за один проход
+        keyboard = [
+            (InlineKeyboardButton(self._exercise_label(exercise, progress), callback_data=f"ex:{week}:{day}:{i}"),)
+            for i, exercise in enumerate(day_data.exercises)
+        ]
+        keyboard.append((InlineKeyboardButton("🔙 Назад", callback_data=f"w:{week}"),))
 
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"back_to_days_{week}")])
+        self._edit_nav_message(query.message.chat_id, query.message.message_id, day_text, InlineKeyboardMarkup(keyboard))
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text=day_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+    @staticmethod
+    def _exercise_label(exercise: ExerciseSpec, progress: Dict) -> str:
+        """Подпись кнопки упражнения со статусом и весом"""
+        ex_progress = progress.get(exercise.id) or _EMPTY_PROGRESS
+        weight = ex_progress.get('weight')
+        status = "✅" if ex_progress.get('completed') else "⭕"
+        weight_info = f" ⚖️ {weight} кг" if weight is not None else ""
+        return f"{status} {exercise.name}{weight_info}"
 
     async def show_exercise_detail(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int, exercise_index: int):
         """Показать детали упражнения"""
         query = update.callback_query
         user_id = query.from_user.id
-        chat_id = query.message.chat_id
-        message_id = query.message.message_id
 
         exercise = self.program.get_exercise(week, day, exercise_index)
         if not exercise:
-            await query.edit_message_text(text="Ошибка: упражнение не найдено.")
+            self._edit_nav_message(query.message.chat_id, query.message.message_id, "Ошибка: упражнение не найдено.")
             return
 
         # Получаем прогресс для этого упражнения
-        progress = self.db.get_user_progress(user_id, week, day)
-        exercise_progress = progress.get(exercise['id'], {})
-        is_completed = exercise_progress.get('completed', False)
-        saved_weight = exercise_progress.get('weight', None)
+        progress = await self.db.get_user_progress(user_id, week, day)
+        is_completed = (progress.get(exercise.id) or _EMPTY_PROGRESS).get('completed', False)
+
+        reply_markup = self._exercise_detail_markup(week, day, exercise_index, exercise, is_completed)
+        self._edit_nav_message(query.message.chat_id, query.message.message_id, self._exercise_detail_text(exercise), reply_markup)
 
+    @staticmethod
+    def _exercise_detail_text(exercise: ExerciseSpec) -> str:
+        """Текст карточки упражнения"""
         exercise_text = (
-            f"*{exercise['name']}*\n"
-            f"🏋️‍♂️ *Группа мышц:* {exercise['group']}\n"
-            f"⚙️ *Тип:* {exercise['type']}\n"
-            f"⚡ *RIR:* {exercise['rir']}\n"
-            f"*Работающие мышцы:* {', '.join(exercise['muscles'])}\n\n"
-            f"*Описание:*\n{exercise['description']}\n\n"
+            f"*{exercise.name}*\n"
+            f"🏋️‍♂️ *Группа мышц:* {exercise.group}\n"
+            f"⚙️ *Тип:* {exercise.type}\n"
+            f"⚡ *RIR:* {exercise.rir}\n"
+            f"*Работающие мышцы:* {', '.join(exercise.muscles)}\n\n"
+            f"*Описание:*\n{exercise.description}\n\n"
             f"*Подходы:*\n"
         )
 
         # Добавляем подходы
-        for i, set_data in enumerate(exercise["sets"], 1):
-            exercise_text += f"{i}. {set_data['reps']} повторений ({set_data['rir_text']})\n"
-
-        # Клавиатура упражнения
-        keyboard = []
+        for i, set_data in enumerate(exercise.sets, 1):
+            exercise_text += f"{i}. {set_data.reps} повторений ({set_data.rir_text})\n"
+        return exercise_text
 
+    @staticmethod
+    def _exercise_detail_markup(week: int, day: int, exercise_index: int, exercise: ExerciseSpec, is_completed: bool) -> InlineKeyboardMarkup:
+        """Клавиатура карточки упражнения"""
         # Кнопки подходов с вводом веса
-        for i, set_data in enumerate(exercise["sets"]):
-             keyboard.append([
-                InlineKeyboardButton(
-                    f"⚖️ Подход {i+1}: ввести вес",
-                    callback_data=f"set_weight_{week}_{day}_{exercise_index}_{i}"
-                )
-            ])
+        keyboard = [
+            (InlineKeyboardButton(f"⚖️ Подход {i+1}: ввести вес", callback_data=f"wt:{week}:{day}:{exercise_index}:{i}"),)
+            for i in range(len(exercise.sets))
+        ]
 
         # Основные кнопки
-        if is_completed:
-            keyboard.append([InlineKeyboardButton("🔄 Отменить выполнение", callback_data=f"toggle_complete_{exercise['id']}_{week}_{day}")])
-        else:
-            keyboard.append([InlineKeyboardButton("✅ Отметить как выполнено", callback_data=f"toggle_complete_{exercise['id']}_{week}_{day}")])
-
-        keyboard.append([
-            InlineKeyboardButton("⏱️ Таймер отдыха", callback_data=f"timer_exercise_{exercise['name']}"),
-            InlineKeyboardButton("📝 Добавить заметку", callback_data=f"add_note_{exercise['id']}")
-        ])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"back_to_exercises_{week}_{day}")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text=exercise_text, parse_mode='Markdown', reply_markup=reply_markup)
+        toggle_text = "🔄 Отменить выполнение" if is_completed else "✅ Отметить как выполнено"
+        keyboard += (
+            (InlineKeyboardButton(toggle_text, callback_data=f"done:{week}:{day}:{exercise_index}"),),
+            (
+                InlineKeyboardButton("⏱️ Таймер отдыха", callback_data=f"tmex:{week}:{day}:{exercise_index}"),
+                InlineKeyboardButton("📝 Добавить заметку", callback_data=f"note:{week}:{day}:{exercise_index}"),
+            ),
+            (InlineKeyboardButton("🔙 Назад", callback_data=f"d:{week}:{day}"),),
+        )
+        return InlineKeyboardMarkup(keyboard)
 
 
     async def progress_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать прогресс пользователя"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
+        message = update.effective_message
+        user_data = await self.db.get_user(user.id)
         if not user_data:
-            await update.message.reply_text("Сначала запустите /start")
+            await message.reply_text("Сначала запустите /start")
             return
 
         progress_text = (
             f"📊 *Ваш прогресс*\n\n"
-            f"👤 *Пользователь:* {user_data[2] or 'Аноним'}\n"
-            f"📅 *Текущая неделя:* {user_data[3]}\n"
-            f"📅 *Текущий день:* {user_data[4]}\n"
-            f"🏋️‍♂️ *Всего тренировок:* {user_data[5]}\n"
-            f"✅ *Завершено упражнений:* {user_data[6]}"
+            # Имя задает пользователь: экранируем, иначе Telegram не разберет разметку
+            f"👤 *Пользователь:* {escape_markdown(user_data['full_name'] or 'Аноним')}\n"
+            f"📅 *Текущая неделя:* {user_data['current_week']}\n"
+            f"📅 *Текущий день:* {user_data['current_day']}\n"
+            f"🏋️‍♂️ *Всего тренировок:* {user_data['total_workouts']}\n"
+            f"✅ *Завершено упражнений:* {user_data['total_exercises']}"
         )
-        keyboard = [
-            [InlineKeyboardButton("📋 Продолжить тренировку", callback_data="current_training")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(progress_text, parse_mode='Markdown', reply_markup=reply_markup)
+        await message.reply_text(progress_text, parse_mode='Markdown', reply_markup=_PROGRESS_MARKUP)
 
 
     async def timer_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать таймер"""
-        timer_text = "⏱️ *Таймер отдыха между подходами*\n\nВыберите время отдыха:"
-        keyboard = [
-            [InlineKeyboardButton("1:00", callback_data="timer_60"), InlineKeyboardButton("1:30", callback_data="timer_90")],
-            [InlineKeyboardButton("2:00", callback_data="timer_120"), InlineKeyboardButton("2:30", callback_data="timer_150")],
-            [InlineKeyboardButton("3:00", callback_data="timer_180"), InlineKeyboardButton("5:00", callback_data="timer_300")],
-            [InlineKeyboardButton("⏱️ Отдохнуть после упражнения", callback_data="timer_after_exercise")], # Кнопка для вызова из упражнения
-            [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(timer_text, parse_mode='Markdown', reply_markup=reply_markup)
+        message = update.effective_message
+        await message.reply_text(_TIMER_MSG, parse_mode='Markdown', reply_markup=_TIMER_MARKUP)
 
 
     async def start_timer(self, chat_id: int, seconds: int, exercise_name: str = "Отдых"):
         """Запуск таймера для пользователя"""
         # Отменяем старый таймер если есть
-        if chat_id in self.active_timers:
-            self.active_timers[chat_id].cancel()
+        if (state := self.timers.get(chat_id)) and not state.job.removed:
+            try:
+                state.job.schedule_removal()
+            except JobLookupError:
+                pass # Тик уже сработал и выполняется: он увидит замену таймера и остановится
 
-        # Сохраняем состояние таймера
         message = await self.application.bot.send_message(
             chat_id=chat_id,
             text=f"⏱️ *Таймер запущен:* {exercise_name}\n⏳ Время: {self.format_time(seconds)}",
             parse_mode='Markdown'
         )
-        self.user_timers[chat_id] = {
-            "seconds": seconds,
-            "message_id": message.message_id,
-            "exercise_name": exercise_name
-        }
 
-        # Запускаем асинхронный таймер
-        timer_task = asyncio.create_task(self.run_timer(chat_id, seconds))
-        self.active_timers[chat_id] = timer_task
-
-    async def run_timer(self, chat_id: int, seconds: int):
-        """Асинхронный таймер"""
-        initial_seconds = seconds
-        while seconds > 0:
-            await asyncio.sleep(1)
-            seconds -= 1
-            if chat_id in self.user_timers and self.user_timers[chat_id]["seconds"] == initial_seconds: # Проверяем, не был ли таймер перезапущен
-                try:
-                    await self.application.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=self.user_timers[chat_id]["message_id"],
-                        text=f"⏱️ *Таймер запущен:* {self.user_timers[chat_id]['exercise_name']}\n⏳ Осталось: {self.format_time(seconds)}",
-                        parse_mode='Markdown'
-                    )
-                except Exception as e:
-                    logger.warning(f"Ошибка обновления таймера: {e}")
-                    break # Прерываем цикл, если сообщение удалено
+        # Тики таймера планирует JobQueue: одна очередь расписания на все чаты
+        state = TimerState(seconds, seconds, message.message_id, exercise_name)
+        self.timers[chat_id] = state
+        self._schedule_timer_tick(chat_id, state)
+
+    def _schedule_timer_tick(self, chat_id: int, state: TimerState):
+        """Запланировать следующее обновление таймера"""
+        # Сообщение обновляем раз в несколько секунд, а не каждую секунду
+        state.job = self.application.job_queue.run_once(
+            self.timer_tick, when=min(TIMER_UPDATE_INTERVAL, state.seconds), data=state, chat_id=chat_id
+        )
+
+    async def timer_tick(self, context: ContextTypes.DEFAULT_TYPE):
+        """Тик таймера: обновить обратный отсчет или сообщить об окончании"""
+        chat_id, state = context.job.chat_id, context.job.data
+        if self.timers.get(chat_id) is not state:
+            return # Таймер перезапущен - новый уже работает
+        state.seconds -= min(TIMER_UPDATE_INTERVAL, state.seconds)
+        if state.seconds > 0:
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=state.message_id,
+                    text=f"⏱️ *Таймер запущен:* {state.name}\n⏳ Осталось: {self.format_time(state.seconds)}",
+                    parse_mode='Markdown'
+                )
+            except Exception as e:
+                logger.warning("Ошибка обновления таймера: %s", e) # Сообщение удалено - завершаем досрочно
+            else:
+                if self.timers.get(chat_id) is state: # Пока шла правка, таймер могли перезапустить
+                    self._schedule_timer_tick(chat_id, state)
+                return
 
         # Таймер закончился
+        if self.timers.get(chat_id) is not state:
+            return
+        del self.timers[chat_id]
         # Отправляем вибрацию/уведомление
-        await self.application.bot.send_message(
+        await context.bot.send_message(
             chat_id=chat_id,
-            text=f"🔔 *Отдых завершен!* Время для следующего подхода! 💪\n(Было: {self.format_time(initial_seconds)})",
+            text=f"🔔 *Отдых завершен!* Время для следующего подхода! 💪\n(Было: {self.format_time(state.initial_seconds)})",
             parse_mode='Markdown'
         )
 
         # Логируем использование таймера
-        if chat_id in self.user_timers:
-            self.db.log_timer_usage(chat_id, self.user_timers[chat_id]['exercise_name'], initial_seconds)
+        await self.db.log_timer_usage(chat_id, state.name, state.initial_seconds)
 
-        # Очищаем таймер
-        if chat_id in self.user_timers:
-            del self.user_timers[chat_id]
-        if chat_id in self.active_timers:
-            del self.active_timers[chat_id]
+    # Готовые строки MM:SS для таймеров до часа
+    _TIME_STR = tuple(f"{s // 60:02d}:{s % 60:02d}" for s in range(0, 3601))
 
     def format_time(self, seconds: int) -> str:
         """Форматирование времени в MM:SS"""
+        if 0 <= seconds <= 3600:
+            return self._TIME_STR[seconds]
         minutes = seconds // 60
         seconds = seconds % 60
         return f"{minutes:02d}:{seconds:02d}"
@@ -629,258 +1240,332 @@ class TrainingBot:
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать статистику"""
         user = update.effective_user
-        user_data = self.db.get_user(user.id)
-        if not user_data:
-            await update.message.reply_text("Сначала запустите /start")
+        message = update.effective_message
+        stats = await self.db.get_user_stats(user.id)
+        if not stats:
+            await message.reply_text("Сначала запустите /start")
             return
 
-        # Получаем дополнительную статистику из базы
-        cursor = self.db.conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(DISTINCT date(completed_at)) as workout_days,
-                   COUNT(*) as total_sets,
-                   AVG(weight) as avg_weight
-            FROM user_progress
-            WHERE user_id = ? AND completed = 1
-        ''', (user.id,))
-        stats = cursor.fetchone()
-
+        created_at = stats['created_at']
         stats_text = (
             f"📈 *Ваша статистика*\n\n"
-            f"👤 *Имя:* {user_data[2] or 'Аноним'}\n"
-            f"📅 *Текущая неделя:* {user_data[3]}\n"
-            f"📅 *Дата регистрации:* {user_data[7].split()[0] if user_data[7] else 'Неизвестно'}\n"
-            f"🏋️‍♂️ *Всего тренировок:* {user_data[5]}\n"
-            f"✅ *Завершено упражнений:* {user_data[6]}\n"
+            f"👤 *Имя:* {escape_markdown(stats['full_name'] or 'Аноним')}\n"
+            f"📅 *Текущая неделя:* {stats['current_week']}\n"
+            f"📅 *Дата регистрации:* {created_at.split()[0] if created_at else 'Неизвестно'}\n"
+            f"🏋️‍♂️ *Всего тренировок:* {stats['total_workouts']}\n"
+            f"✅ *Завершено упражнений:* {stats['total_exercises']}\n"
         )
 
-        if stats and stats[0]:
+        if stats['workout_days']:
             stats_text += (
-                f"📊 *Дней тренировок:* {stats[0]}\n"
-                f"🔢 *Всего подходов:* {stats[1]}\n"
+                f"📊 *Дней тренировок:* {stats['workout_days']}\n"
+                f"🔢 *Всего подходов:* {stats['total_sets']}\n"
             )
-        if stats[2]:
-            stats_text += f"⚖️ *Средний вес:* {stats[2]:.1f} кг\n"
+        if stats['avg_weight']:
+            stats_text += f"⚖️ *Средний вес:* {stats['avg_weight']:.1f} кг\n"
 
         stats_text += "\n*Продолжайте в том же духе! 💪*"
 
-        keyboard = [
-            [InlineKeyboardButton("📋 Продолжить тренировку", callback_data="current_training")],
-            [InlineKeyboardButton("📅 История тренировок", callback_data="workout_history")], # Пока без реализации
-            [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(stats_text, parse_mode='Markdown', reply_markup=reply_markup)
+        await message.reply_text(stats_text, parse_mode='Markdown', reply_markup=_STATS_MARKUP)
 
 
     async def reset_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Предложить сброс прогресса"""
-        keyboard = [
-            [InlineKeyboardButton("✅ Да, сбросить всё", callback_data="reset_confirm")],
-            [InlineKeyboardButton("❌ Нет, отмена", callback_data="main_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("⚠️ *Вы уверены, что хотите сбросить весь прогресс?*", parse_mode='Markdown', reply_markup=reply_markup)
+        message = update.effective_message
+        await message.reply_text("⚠️ *Вы уверены, что хотите сбросить весь прогресс?*", parse_mode='Markdown', reply_markup=_RESET_CONFIRM_MARKUP)
 
 
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик кнопок (callback_query)"""
         query = update.callback_query
-        await query.answer()
-        data = query.data
-        user_id = query.from_user.id
-        chat_id = query.message.chat_id
-        message_id = query.message.message_id
+        if query.message is None: # Кнопки под inline-сообщениями не обрабатываем
+            await query.answer()
+            return
+        kind, _, payload = (query.data or "").partition(":")
 
         # --- Обработка команд кнопок ---
-        if data.startswith("week_"):
-            week = int(data.split("_")[1])
-            await self.show_day_selection(chat_id, week, message_id)
-        elif data.startswith("day_"):
-            parts = data.split("_")
-            week, day = int(parts[1]), int(parts[2])
-            await self.show_exercise_list(update, context, week, day)
-        elif data.startswith("exercise_"):
-            parts = data.split("_")
-            week, day, ex_idx = int(parts[1]), int(parts[2]), int(parts[3])
-            await self.show_exercise_detail(update, context, week, day, ex_idx)
-        elif data.startswith("toggle_complete_"):
-            parts = data.split("_")
-            exercise_id, week, day = parts[2], int(parts[3]), int(parts[4])
-            # Получаем текущий статус
-            current_progress = self.db.get_user_progress(user_id, week, day)
-            new_status = not current_progress.get(exercise_id, {}).get('completed', False)
-            self.db.update_exercise_status(user_id, week, day, exercise_id, new_status)
-            # После изменения статуса, возвращаемся к списку упражнений
-            await self.show_exercise_list(update, context, week, day)
-        elif data.startswith("set_weight_"):
-            # Этот тип кнопки переводит бота в режим ожидания ввода веса
-            parts = data.split("_")
-            week, day, ex_idx, set_num = int(parts[2]), int(parts[3]), int(parts[4]), int(parts[5])
-            exercise = self.program.get_exercise(week, day, ex_idx)
-            if exercise:
-                context.user_data['waiting_for_weight'] = {'week': week, 'day': day, 'exercise_id': exercise['id']}
-                await query.edit_message_text(
-                    text=f"Введите вес для '{exercise['name']}' (Подход {set_num+1}):",
-                    parse_mode='Markdown'
-                )
-            else:
-                 await query.edit_message_text(text="Ошибка: упражнение не найдено.")
-        elif data.startswith("timer_"):
-            if data == "timer_after_exercise":
-                 # Эта кнопка должна передавать название упражнения, но пока просто покажем выбор времени
-                 # Можно модифицировать, чтобы передавать упражнение
-                 await self.timer_command(update, context)
-                 return
-            seconds_str = data.split("_")[1]
-            if seconds_str.isdigit():
-                seconds = int(seconds_str)
-                await self.start_timer(chat_id, seconds)
-                await query.edit_message_text(text=f"⏱️ Таймер на {self.format_time(seconds)} запущен!", parse_mode='Markdown')
-        elif data.startswith("timer_exercise_"):
-            exercise_name = data[len("timer_exercise_"):]
-            await self.start_timer(chat_id, 90, exercise_name) # Стандартное время 90 секунд
-        elif data == "program_main":
-            await self.show_week_selection(chat_id, message_id)
-        elif data.startswith("back_to_"):
-            if data == "back_to_weeks":
-                await self.show_week_selection(chat_id, message_id)
-            elif data.startswith("back_to_days_"):
-                week = int(data.split("_")[3])
-                await self.show_day_selection(chat_id, week, message_id)
-            elif data.startswith("back_to_exercises_"):
-                parts = data.split("_")
-                week, day = int(parts[3]), int(parts[4])
-                await self.show_exercise_list(update, context, week, day)
-        elif data == "main_menu":
-            await self.show_main_menu(chat_id, message_id)
-        elif data == "current_training":
-            user_data_db = self.db.get_user(user_id)
-            if user_data_db:
-                week, day = user_data_db[3], user_data_db[4] # current_week, current_day
-                await self.show_exercise_list(update, context, week, day)
-            else:
-                 await self.show_week_selection(chat_id, message_id) # Если нет данных, вернем к выбору недели
-        elif data == "help_main":
-            await self.help_command(update, context)
-        elif data == "stats_main":
-            await self.stats_command(update, context)
-        elif data == "reset_confirm":
-            # Сброс прогресса пользователя
-            cursor = self.db.conn.cursor()
-            cursor.execute('DELETE FROM user_progress WHERE user_id = ?', (user_id,))
-            cursor.execute('UPDATE users SET total_exercises = 0, total_workouts = 0 WHERE id = ?', (user_id,))
-            self.db.conn.commit()
-            await query.edit_message_text(
-                text="✅ *Прогресс сброшен!\nНачните новую тренировку с /program*",
-                parse_mode='Markdown'
-            )
-        else:
-            await query.edit_message_text(text="Неизвестная команда кнопки.")
+        handler = self.callbacks.get(kind)
+        try:
+            args = [int(arg) for arg in payload.split(":")] if payload else []
+        except ValueError:
+            handler = None
+        if handler is None:
+            # Уведомление вместо правки сообщения: answerCallbackQuery не расходует лимит на сообщения
+            await query.answer("Неизвестная команда кнопки.", show_alert=True)
+            return
+        if handler not in self.toast_callbacks:
+            await query.answer()
+        await handler(update, context, *args)
 
+    async def _on_week(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int):
+        """Кнопка недели: выбор дня"""
+        message = update.callback_query.message
+        await self.show_day_selection(message.chat_id, week, message.message_id)
 
-    async def message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик текстовых сообщений"""
-        user_id = update.effective_user.id
-        chat_id = update.effective_chat.id
-        text = update.message.text
+    async def _on_day(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int):
+        """Кнопка дня: список упражнений"""
+        await self.show_exercise_list(update, context, week, day)
 
-        # Проверяем, ожидаем ли мы ввод веса
-        if context.user_data.get('waiting_for_weight'):
-            weight_info = context.user_data['waiting_for_weight']
-            try:
-                weight = float(text.replace(',', '.')) # Заменяем запятую на точку для парсинга
-                self.db.save_exercise_weight(user_id, weight_info['week'], weight_info['day'], weight_info['exercise_id'], weight)
+    async def _on_exercise(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int, ex_idx: int):
+        """Кнопка упражнения: карточка упражнения"""
+        await self.show_exercise_detail(update, context, week, day, ex_idx)
 
-                # Убираем флаг ожидания
-                del context.user_data['waiting_for_weight']
+    async def _on_toggle_complete(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int, ex_idx: int):
+        """Отметить упражнение выполненным или снять отметку"""
+        query = update.callback_query
+        message = query.message
+        exercise = self.program.get_exercise(week, day, ex_idx)
+        if not exercise:
+            self._edit_nav_message(message.chat_id, message.message_id, "Ошибка: упражнение не найдено.")
+            return
+        exercise_id = exercise.id
+        user_id = query.from_user.id
+        # Получаем текущий статус
+        current_progress = await self.db.get_user_progress(user_id, week, day)
+        new_status = not (current_progress.get(exercise_id) or _EMPTY_PROGRESS).get('completed', False)
+        await self.db.update_exercise_status(user_id, week, day, exercise_id, new_status)
+
+        # Текст карточки от статуса не зависит - меняем только кнопку выполнения
+        self._edit_nav_markup(
+            message.chat_id, message.message_id,
+            self._exercise_detail_markup(week, day, ex_idx, exercise, new_status), self._exercise_detail_text(exercise)
+        )
 
-                # Возвращаемся к деталям упражнения
-                week, day = weight_info['week'], weight_info['day']
-                ex_index = int(weight_info['exercise_id'].split('-')[2]) - 1 # Предполагаем формат ID 1-1-1
-                await self.show_exercise_detail(update, context, week, day, ex_index)
+    async def prompt_weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Кнопка подхода (wt:неделя:день:номер:подход): запросить вес"""
+        query = update.callback_query
+        await query.answer()
+        week, day, ex_idx, set_num = (int(arg) for arg in query.data.split(":")[1:])
+        message = query.message
+        exercise = self.program.get_exercise(week, day, ex_idx)
+        if not exercise:
+            self._edit_nav_message(message.chat_id, message.message_id, "Ошибка: упражнение не найдено.")
+            return ConversationHandler.END
+        context.user_data['waiting_for_weight'] = {'week': week, 'day': day, 'ex_idx': ex_idx, 'exercise_id': exercise.id}
+        # Обычный текст: разметки здесь нет, а название упражнения не нужно экранировать
+        self._edit_nav_message(
+            message.chat_id, message.message_id,
+            f"Введите вес для '{exercise.name}' (Подход {set_num+1}):\n/cancel - отмена", parse_mode=None
+        )
+        return AWAIT_WEIGHT
+
+    async def receive_weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сохранить введенный вес и показать карточку упражнения"""
+        message = update.effective_message
+        weight_info = context.user_data.get('waiting_for_weight')
+        if weight_info is None:
+            return ConversationHandler.END
+        try:
+            weight = float(message.text.replace(',', '.')) # Заменяем запятую на точку для парсинга
+        except ValueError:
+            await message.reply_text("❌ Пожалуйста, введите корректное число для веса (например, 60.5).")
+            return AWAIT_WEIGHT
+        # Снимаем состояние до первого await: параллельно обрабатываемое второе число его уже не найдет
+        context.user_data.pop('waiting_for_weight', None)
+
+        week, day, ex_index, exercise_id = (
+            weight_info['week'], weight_info['day'], weight_info['ex_idx'], weight_info['exercise_id']
+        )
+        await self.db.save_exercise_weight(update.effective_user.id, week, day, exercise_id, weight)
+
+        # Возвращаемся к деталям упражнения новым сообщением: отвечаем на текст, а не на кнопку
+        exercise = self.program.get_exercise(week, day, ex_index)
+        if exercise:
+            progress = await self.db.get_user_progress(update.effective_user.id, week, day)
+            is_completed = (progress.get(exercise_id) or _EMPTY_PROGRESS).get('completed', False)
+            await message.reply_text(
+                self._exercise_detail_text(exercise),
+                parse_mode='Markdown',
+                reply_markup=self._exercise_detail_markup(week, day, ex_index, exercise, is_completed)
+            )
+        return ConversationHandler.END
 
-            except ValueError:
-                await update.message.reply_text("❌ Пожалуйста, введите корректное число для веса (например, 60.5).")
+    async def weight_busy(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Ответ на нажатие или текст, пока предыдущий шаг ввода веса не закончен"""
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Подождите, вес сохраняется...")
         else:
-            # Обработка обычных текстовых сообщений
-            text_lower = text.lower()
-            if text_lower in ["программа", "тренировка"]:
-                await self.program_command(update, context)
-            elif text_lower in ["прогресс", "статистика"]:
-                await self.progress_command(update, context)
-            else:
-                await update.message.reply_text("Используйте команды или кнопки для навигации. /help - список команд")
-
+            await update.effective_message.reply_text("⏳ Подождите, вес сохраняется...")
+
+    async def cancel_weight(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Отменить ввод веса"""
+        if not self._addressed_to_me(context.matches[0], context):
+            return None # Команда другому боту: остаемся в ожидании веса
+        context.user_data.pop('waiting_for_weight', None)
+        await update.effective_message.reply_text("Ввод веса отменен.")
+        return ConversationHandler.END
+
+    async def _on_timer(self, update: Update, context: ContextTypes.DEFAULT_TYPE, seconds: int):
+        """Запустить таймер на выбранное время"""
+        query = update.callback_query
+        await query.answer(f"⏱️ Таймер на {self.format_time(seconds)} запущен!") # Меню таймера остается на месте
+        await self.start_timer(query.message.chat_id, seconds)
 
-    async def show_main_menu(self, chat_id: int, message_id: int):
-        """Показать главное меню"""
-        keyboard = [
-            [InlineKeyboardButton("📋 Программа тренировок", callback_data="program_main")],
-            [InlineKeyboardButton("⏱️ Таймер отдыха", callback_data="timer_main")],
-            [InlineKeyboardButton("📊 Моя статистика", callback_data="stats_main")],
-            [InlineKeyboardButton("🆘 Помощь", callback_data="help_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        text = "🏋️‍♂️ *Главное меню*\n\nВыберите действие:"
-        if message_id:
-            await self.application.bot.edit_message_text(
-                chat_id=chat_id, message_id=message_id, text=text, parse_mode='Markdown', reply_markup=reply_markup
-            )
+    async def _on_timer_exercise(self, update: Update, context: ContextTypes.DEFAULT_TYPE, week: int, day: int, ex_idx: int):
+        """Таймер отдыха из карточки упражнения"""
+        exercise = self.program.get_exercise(week, day, ex_idx)
+        exercise_name = exercise.name if exercise else "Отдых"
+        query = update.callback_query
+        await query.answer(f"⏱️ Таймер на {self.format_time(90)} запущен!")
+        await self.start_timer(query.message.chat_id, 90, exercise_name) # Стандартное время 90 секунд
+
+    async def _on_week_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Вернуться к выбору недели"""
+        message = update.callback_query.message
+        await self.show_week_selection(message.chat_id, message.message_id)
+
+    async def _on_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Вернуться в главное меню"""
+        message = update.callback_query.message
+        await self.show_main_menu(message.chat_id, message.message_id)
+
+    async def _on_current_training(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Открыть день, на котором пользователь остановился"""
+        user_data_db = await self.db.get_user(update.callback_query.from_user.id)
+        if user_data_db:
+            week, day = user_data_db['current_week'], user_data_db['current_day']
+            await self.show_exercise_list(update, context, week, day)
         else:
-            await self.application.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown', reply_markup=reply_markup)
+            await self._on_week_selection(update, context) # Если нет данных, вернем к выбору недели
 
+    async def _on_reset_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сброс прогресса пользователя"""
+        query = update.callback_query
+        await self.db.reset_user(query.from_user.id)
+        self._edit_nav_message(
+            query.message.chat_id, query.message.message_id, "✅ *Прогресс сброшен!\nНачните новую тренировку с /program*"
+        )
 
-    def run(self):
-        """Запустить бота"""
-        logger.info("Бот запущен...")
-        # Используем polling для Render
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    async def message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик текстовых сообщений"""
+        message = update.effective_message
+        if message is None:
+            return
+        # Обработка обычных текстовых сообщений (ввод веса перехватывает диалог ConversationHandler)
+        text_lower = message.text.lower()
+        if text_lower in _PROGRAM_WORDS:
+            await self.program_command(update, context)
+        elif text_lower in _PROGRESS_WORDS:
+            await self.progress_command(update, context)
+        else:
+            await message.reply_text("Используйте команды или кнопки для навигации. /help - список команд")
 
-# ==================== ЗАПУСК БОТА ====================
-import signal
-import sys
 
-async def amain():
-    """Асинхронная основная функция запуска для Render."""
-    TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not TOKEN or TOKEN == 'YOUR_BOT_TOKEN_HERE':
-        logger.error("❌ Пожалуйста, установите токен бота в переменной окружения TELEGRAM_BOT_TOKEN")
-        sys.exit(1) # Завершаем скрипт с кодом ошибки
+    async def show_main_menu(self, chat_id: int, message_id: int):
+        """Показать главное меню"""
+        if message_id:
+            self._edit_nav_message(chat_id, message_id, _MAIN_MENU_TEXT, _MAIN_MENU_MARKUP)
+        else:
+            await self.application.bot.send_message(chat_id=chat_id, text=_MAIN_MENU_TEXT, parse_mode='Markdown', reply_markup=_MAIN_MENU_MARKUP)
+
+
+    async def serve(self):
+        """Запустить бота в текущем цикле событий и работать до сигнала остановки"""
+        application = self.application
+        initialized = False
+        try:
+            await self.db.connect()
+            # Инициализируем приложение
+            await application.initialize()
+            initialized = True
+            await self.cache_static_replies()
+            await application.start()
+
+            webhook_url = os.getenv('WEBHOOK_URL')
+            if webhook_url:
+                # Telegram сам присылает обновления, webhook регистрируется при старте
+                await application.updater.start_webhook(
+                    listen="0.0.0.0",
+                    port=int(os.getenv("PORT", 8443)),
+                    url_path=self.token,
+                    webhook_url=f"{webhook_url.rstrip('/')}/{self.token}",
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                logger.info("✅ Бот запущен и работает (webhook).")
+            else:
+                await application.updater.start_polling(
+                    poll_interval=0.0,
+                    timeout=POLL_TIMEOUT,
+                    bootstrap_retries=-1,
+                    allowed_updates=ALLOWED_UPDATES
+                )
+                logger.info("✅ Бот запущен и работает (polling).")
 
-    # Создаем бота
-    bot = TrainingBot(TOKEN)
+            # Ожидаем сигнал остановки (например, SIGTERM от Render)
+            loop = asyncio.get_running_loop()
+            stop_event = asyncio.Event()
+            def signal_handler(*args):
+                logger.info("Получен сигнал остановки. Завершаем работу...")
+                loop.call_soon_threadsafe(stop_event.set)
 
-    try:
-        # Инициализируем приложение
-        await bot.application.initialize()
-        # Запускаем polling
-        await bot.application.start()
-        logger.info("✅ Бот запущен и работает (polling).")
+            for sig in (signal.SIGTERM, signal.SIGINT): # SIGINT - для Ctrl+C локально
+                try:
+                    # Сигнал будит сам цикл событий, а не прерывает произвольный await
+                    loop.add_signal_handler(sig, signal_handler)
+                except NotImplementedError: # Windows: в цикле событий нет обработчиков сигналов
+                    signal.signal(sig, signal_handler)
 
-        # Ожидаем сигнал остановки (например, SIGTERM от Render)
-        stop_event = asyncio.Event()
-        def signal_handler():
-            logger.info("Получен сигнал остановки. Завершаем работу...")
-            stop_event.set()
+            await stop_event.wait() # Ждем сигнала остановки
 
-        signal.signal(signal.SIGTERM, signal_handler)
-        signal.signal(signal.SIGINT, signal_handler) # Для Ctrl+C локально
+        finally:
+            # Запуск мог сорваться на любом шаге (например, отозванный токен): останавливаем только то, что успело запуститься
+            logger.info("Останавливаем бота...")
+            try:
+                if application.updater.running:
+                    await application.updater.stop()
+                if application.running:
+                    # Вместе с приложением останавливается JobQueue: тики таймеров больше не придут
+                    await application.stop()
+                self.timers.clear() # Таймеры отдыха не переживут перезапуск
+                # HTTP-клиент закрывается - ждущие правки не отправить
+                edit_tasks = list(self._pending_edits.values())
+                for task in edit_tasks:
+                    task.cancel()
+                await asyncio.gather(*edit_tasks, return_exceptions=True)
+                if initialized:
+                    await application.shutdown()
+            finally:
+                # Потоки aiosqlite не daemon: без закрытия базы процесс не завершится
+                await self.db.close()
+            logger.info("Бот остановлен.")
 
-        await stop_event.wait() # Ждем сигнала остановки
 
-    finally:
-        logger.info("Останавливаем бота...")
-        await bot.application.stop()
-        await bot.application.shutdown()
-        logger.info("Бот остановлен.")
+# ==================== ЗАПУСК БОТА ====================
+async def amain(token: str):
+    """Асинхронная основная функция запуска для Render."""
+    # Бот создается в цикле, где будет работать: очереди PTB, JobQueue и писателя базы привязаны к нему
+    bot = TrainingBot(token)
+    await bot.serve()
 
 
 def main():
     """Синхронная точка входа для Render."""
+    # Проверяем токен до любой настройки, чтобы неудачный запуск завершался сразу
+    try:
+        token = os.environ['TELEGRAM_BOT_TOKEN']
+    except KeyError:
+        token = ''
+    if token in ('', 'YOUR_BOT_TOKEN_HERE'):
+        logger.error("❌ Пожалуйста, установите токен бота в переменной окружения TELEGRAM_BOT_TOKEN")
+        sys.exit(1) # Завершаем скрипт с кодом ошибки
+
+    # Настройка логирования: время к каждой строке добавляет сам Render
+    logging.basicConfig(
+        format='%(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    # httpx пишет INFO-строку на каждый запрос к Bot API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # uvloop быстрее стандартного цикла событий; на Windows его нет
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     # Используем asyncio.run для запуска асинхронной main функции
-    asyncio.run(amain())
+    asyncio.run(amain(token))
 
 
 if __name__ == '__main__':